@@ -29,6 +29,9 @@ here = os.path.abspath(os.path.dirname(__file__))
 with open(os.path.join(here, 'README.rst')) as f:
     long_description = f.read()
 
+with open(os.path.join(here, 'requirements.txt')) as f:
+    install_requires = [line.strip() for line in f if line.strip()]
+
 setup(
     name='sshecret',
     version='20191018',
@@ -38,7 +41,7 @@ setup(
     author='Tyler Cipriani',
     author_email='tyler@tylercipriani.com',
     license='GNU GPLv3',
-    install_requires=[line.strip() for line in open('requirements.txt')],
+    install_requires=install_requires,
     classifiers=[
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Operating System :: POSIX :: Linux',
@@ -20,21 +20,21 @@
 # sshecret is a wrapper around ssh that automatically manages multiple
 # ssh-agent(1)s each containing only a single ssh key.
 
-import argparse
+import base64
+import contextlib
 import errno
 import hashlib
+import json
 import logging
 import os
+import pwd
+import socket
 from shlex import quote
 import subprocess
+import stat
 import sys
-
-
-try:
-    from paramiko import SSHConfig
-except ImportError:
-    print("[ERROR] sudo apt-get install python-paramiko")
-    sys.exit(1)
+import tempfile
+import types
 
 
 DESCRIPTION = '''
@@ -54,18 +54,28 @@ In order to retrieve the path to the socket for a given hostname, use:
 
 
 LOG_FORMAT = '%(asctime)s %(filename)s %(message)s'
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
 
-# Intentionally omit ``-v`` since I want to be able to see debug output
-# for this script when passing ``-v`` as well.
-SSH_FLAGS = ['-1', '-2', '-4', '-6', '-A', '-a', '-C', '-f', '-g',
-             '-K', '-k', '-M', '-N', '-n', '-q', '-s', '-T', '-t',
-             '-V', '-X', '-x', '-Y', '-y']
+USAGE = 'usage: sshecret [--socket] [whatever you want to pass to ssh]'
+
+
+OPTIONS = '''
+options:
+  -h, --help  show this help message and exit
+  -v          Increase verbosity of output
+  --socket    print socket path for the given host'''
 
 
-SSH_ARGS = ['-b', '-c', '-D', '-E', '-e', '-F', '-I', '-i', '-J', '-L',
-            '-l', '-m', '-O', '-o', '-p', '-Q', '-R', '-S', '-w', '-W']
+# ssh(1) options that take a value, which may be attached (``-p2222``) or
+# the next argument (``-p 2222``). Every other flag is passed through as-is.
+SSH_ARGS = frozenset([
+    '-B', '-b', '-c', '-D', '-E', '-e', '-F', '-I', '-i', '-J', '-L',
+    '-l', '-m', '-O', '-o', '-P', '-p', '-Q', '-R', '-S', '-W', '-w'])
+
+
+# Resolved host configs keyed by (path, mtime, host), shared between SSHKey
+# instances
+_CONFIG_CACHE = {}
 
 
 class SSHSock():
@@ -75,42 +85,151 @@ class SSHSock():
 
     def __init__(self, key):
         self.key = key
+        self._sock_path = None
 
     def get_sock_path(self):
         """
         Path for SSH socket files
         """
-        checksum = hashlib.md5()
-        checksum.update(self.key.file.encode("utf-8"))
-        hexdigest = checksum.hexdigest()
+        if self._sock_path is not None:
+            return self._sock_path
 
-        sock = os.path.join(
-            os.getenv("XDG_RUNTIME_DIR"), "{}.sock".format(hexdigest))
-        logging.debug("Sock path is: {}".format(sock))
-        return sock
+        hexdigest = hashlib.blake2b(
+            self.key.file.encode("utf-8"), digest_size=16).hexdigest()
 
-    def _add_key(self, sock_file):
+        self._sock_path = os.path.join(
+            os.getenv("XDG_RUNTIME_DIR"), f"{hexdigest}.sock")
+        logging.debug("Sock path is: %s", self._sock_path)
+        self._migrate_legacy_sock(self._sock_path)
+        return self._sock_path
+
+    def _migrate_legacy_sock(self, sock_file):
         """
-        Add key to existing socket
+        Move an agent socket from its old MD5-based name to sock_file
+
+        Earlier releases named sockets after the MD5 of the identity file.
+        Renaming keeps those agents in use rather than leaving them running,
+        unreachable, with the key still unlocked.
         """
-        env = os.environ.copy()
-        env['SSH_AUTH_SOCK'] = sock_file
+        try:
+            hexdigest = hashlib.md5(self.key.file.encode("utf-8")).hexdigest()
+        except ValueError:
+            # MD5 is unavailable on FIPS builds, so no legacy socket exists
+            return
 
-        if self.key.check_key_exists(env):
-            logging.debug(
-                "SSH Key {} already in sock".format(self.key.file))
+        legacy = os.path.join(os.path.dirname(sock_file), f"{hexdigest}.sock")
+        if not os.path.exists(legacy) or os.path.lexists(sock_file):
             return
 
+        logging.debug("Moving legacy sock %s to %s", legacy, sock_file)
+        os.replace(legacy, sock_file)
+        try:
+            os.replace(self._get_pid_path(legacy),
+                       self._get_pid_path(sock_file))
+        except FileNotFoundError:
+            pass
+
+    def _get_pid_path(self, sock_file):
+        """
+        Path for the file holding the pid of the socket's ssh-agent
+        """
+        return sock_file + ".pid"
+
+    def _agent_running(self, sock_file):
+        """
+        Check whether an ssh-agent is still serving the socket
+
+        Agents without a readable pid file, such as ones moved from a
+        legacy socket name, are checked by connecting to the socket.
+        """
+        try:
+            st = os.stat(sock_file)
+        except FileNotFoundError:
+            return False
+
+        if not stat.S_ISSOCK(st.st_mode):
+            return False
+
+        try:
+            with open(self._get_pid_path(sock_file), "rb") as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            return self._sock_listening(sock_file)
+
+        return os.path.exists("/proc/{}".format(pid))
+
+    def _sock_listening(self, sock_file):
+        """
+        Check whether anything accepts connections on the socket
+        """
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(sock_file)
+            except (ConnectionRefusedError, FileNotFoundError):
+                return False
+        return True
+
+    def _start_agent(self, sock_file):
+        """
+        Start a new ssh-agent listening on the socket
+        """
+        # Clear out a stale socket and pid file
+        for path in (sock_file, self._get_pid_path(sock_file)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        # -s: always print Bourne shell syntax, whatever $SHELL is, so the
+        # pid can be parsed
+        cmd = [
+            "/usr/bin/ssh-agent",
+            "-s",
+            "-a{}".format(sock_file),
+        ]
+
+        out = subprocess.check_output(cmd)
+        for field in out.split(b";"):
+            name, _, value = field.strip().partition(b"=")
+            if name == b"SSH_AGENT_PID":
+                with open(self._get_pid_path(sock_file), "wb") as f:
+                    f.write(value)
+                logging.debug("ssh-agent pid is: %s", value.decode())
+                break
+
+    @contextlib.contextmanager
+    def _use_sock(self, sock_file):
+        """
+        Point SSH_AUTH_SOCK at the socket while running ssh-add
+
+        Sets it in our own environment rather than handing subprocesses a
+        copy of the whole thing.
+        """
+        old_sock = os.environ.get('SSH_AUTH_SOCK')
+        os.environ['SSH_AUTH_SOCK'] = sock_file
+        try:
+            yield
+        finally:
+            if old_sock is None:
+                del os.environ['SSH_AUTH_SOCK']
+            else:
+                os.environ['SSH_AUTH_SOCK'] = old_sock
+
+    def _add_key(self, sock_file):
+        """
+        Add key to existing socket
+        """
         logging.debug(self.key.file)
-        cmd = ["/usr/bin/ssh-add", self.key.file]
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                env=env)
+        cmd = ["/usr/bin/ssh-add", "-q", self.key.file]
 
-        (stdout, stderr) = proc.communicate()
+        with self._use_sock(sock_file):
+            # stdin is left alone: ssh-add prompts on the terminal, or falls
+            # back to SSH_ASKPASS when stdin isn't a tty
+            error = subprocess.call(cmd,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
 
-        if proc.returncode:
+        if error:
             raise OSError(
                 1,
                 "Could not add identityfile sock file",
@@ -127,15 +246,16 @@ class SSHSock():
             return
 
         sock_file = self.get_sock_path()
-        if not os.path.exists(sock_file):
-            cmd = [
-                "/usr/bin/ssh-agent",
-                "-a{}".format(sock_file),
-            ]
-
-            error = subprocess.check_call(cmd)
-            if error:
-                raise OSError(1, "Could not create sock file", sock_file)
+        if not self._agent_running(sock_file):
+            self._start_agent(sock_file)
+        else:
+            # A fresh agent is known to be empty; a running one may have
+            # had the key deleted, expired or regenerated, so ask it
+            with self._use_sock(sock_file):
+                if self.key.check_key_exists():
+                    logging.debug(
+                        "SSH Key %s already in sock", self.key.file)
+                    return sock_file
 
         self._add_key(sock_file)
         return sock_file
@@ -148,41 +268,209 @@ class SSHKey():
 
     def __init__(self, host):
         """
-        Find the identity file based on hostname
+        Remember the hostname; the ssh config is only read once needed
         """
-        config = SSHConfig()
-        config.parse(open(self._get_ssh_config()))
-        host_config = config.lookup(host)
-        id_file = host_config.get("identityfile")
-        self.id_file = None
+        self.host = host
         self.fingerprint = None
+        self._config = None
+        self._id_file = None
+
+    def _resolve(self):
+        """
+        Look up the host's config and identity file on first use
+
+        The identity file is expanded to a canonical absolute path, so the
+        same key always hashes to the same socket. Relative paths are taken
+        from the current directory, as ssh does.
+        """
+        if self._config is not None:
+            return
+
+        self._config = self._load_config()
+        id_file = self._config.get("identityfile")
         if id_file is not None:
-            self.id_file = id_file[::-1][0]
-            logging.debug("SSH identity file is: {}".format(self.id_file))
+            id_file = self._expand_tokens(id_file[-1])
+            self._id_file = os.path.realpath(
+                os.path.expanduser(os.path.expandvars(id_file)))
+            logging.debug("SSH identity file is: %s", self._id_file)
+
+    def _expand_tokens(self, path):
+        """
+        Expand the ssh_config(5) %-tokens ssh -G leaves in IdentityFile
+
+        Handles %%, %C, %d, %h, %i, %k, %L, %l, %n, %p, %r and %u; any
+        other token is left as-is.
+        """
+        config = self._config
+        local_host = socket.gethostname()
+        host = config.get("hostname", [self.host])[0]
+        port = config.get("port", ["22"])[0]
+        user = config.get("user", ["%r"])[0]
+        tokens = {
+            "%": "%",
+            "d": os.path.expanduser("~"),
+            "h": host,
+            "i": str(os.getuid()),
+            "k": config.get("hostkeyalias", [self.host])[0],
+            "L": local_host.partition(".")[0],
+            "l": local_host,
+            "n": self.host,
+            "p": port,
+            "r": user,
+            "u": pwd.getpwuid(os.getuid()).pw_name,
+        }
+        tokens["C"] = hashlib.sha1(
+            (local_host + host + port + user).encode("utf-8")).hexdigest()
+
+        expanded = []
+        chars = iter(path)
+        for char in chars:
+            if char == "%":
+                token = next(chars, "")
+                char = tokens.get(token, "%" + token)
+            expanded.append(char)
+        return "".join(expanded)
+
+    @property
+    def _host_config(self):
+        """
+        The ssh config for the host, parsed on first access
+        """
+        self._resolve()
+        return self._config
+
+    @property
+    def id_file(self):
+        """
+        Find the identity file based on hostname
+        """
+        self._resolve()
+        return self._id_file
+
+    def _load_config(self):
+        """
+        Resolve the host's config with ``ssh -G``, reusing earlier lookups
+        """
+        path, st = self._get_ssh_config()
+        key = (path, st.st_mtime_ns, self.host)
+        host_config = _CONFIG_CACHE.get(key)
+        if host_config is not None:
+            return host_config
+
+        # Without an IdentityFile of its own, ssh -G lists every default
+        # identity; seeding it with "none" keeps those out of the output.
+        cmd = [
+            "/usr/bin/ssh",
+            "-G",
+            "-F", path,
+            "-o", "IdentityFile=none",
+            self.host]
+
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        host_config = {}
+        for line in proc.stdout.splitlines():
+            name, _, value = line.partition(" ")
+            if name == "identityfile" and value == "none":
+                continue
+            host_config.setdefault(name, []).append(value)
+
+        _CONFIG_CACHE[key] = host_config
+        return host_config
 
     def _get_ssh_config(self):
         """
         Try to find ssh config file at default location
+
+        Returns the path along with its stat result.
         """
         default = os.path.join(os.getenv("HOME"), ".ssh", "config")
         path = os.getenv("SSH_CONF_PATH", default)
-        logging.debug("SSH config path is: {}".format(path))
-        if not os.path.exists(path) or not os.path.isfile(path):
+        logging.debug("SSH config path is: %s", path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise IOError(
                 errno.ENOENT,
                 "File not found", path)
 
-        return path
+        return path, st
 
-    def get_fingerprint(self):
+    def _fingerprint_cache_path(self):
         """
-        Return fingerprint of SSH identity file
+        Path for the on-disk fingerprint cache
         """
-        if self.id_file is None:
+        return os.path.join(os.getenv("XDG_RUNTIME_DIR"), "sshecret-fp.json")
+
+    def _read_fingerprint_cache(self):
+        """
+        Load the fingerprint cache, treating anything unreadable as empty
+        """
+        try:
+            with open(self._fingerprint_cache_path()) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def _write_fingerprint_cache(self, cache):
+        """
+        Atomically replace the fingerprint cache
+        """
+        path = self._fingerprint_cache_path()
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=".sshecret-fp.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, path)
+        except OSError:
+            logging.debug("Could not write fingerprint cache %s", path)
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _get_pubkey_fingerprint(self):
+        """
+        Compute the SHA256 fingerprint from the identity's public key file
+
+        Returns None if there is no usable public key next to the identity.
+        """
+        pub_file = self.id_file
+        if not pub_file.endswith(".pub"):
+            pub_file += ".pub"
+
+        try:
+            with open(pub_file, "rb") as f:
+                fields = f.read().split()
+            blob = base64.b64decode(fields[1], validate=True)
+        except (OSError, IndexError, ValueError):
+            logging.debug("No usable public key at %s", pub_file)
             return None
 
-        if self.fingerprint is not None:
-            return self.fingerprint
+        digest = base64.b64encode(hashlib.sha256(blob).digest())
+        return b"SHA256:" + digest.rstrip(b"=")
+
+    def _get_keygen_fingerprint(self):
+        """
+        Ask ssh-keygen for the fingerprint of the identity file
+
+        Fingerprints are cached in $XDG_RUNTIME_DIR keyed on the identity
+        file's mtime and size, so ssh-keygen only runs when the key changes.
+        """
+        st = os.stat(self.id_file)
+        cache = self._read_fingerprint_cache()
+        entry = cache.get(self.id_file)
+        if (isinstance(entry, dict) and
+                entry.get("mtime") == st.st_mtime_ns and
+                entry.get("size") == st.st_size and
+                isinstance(entry.get("fingerprint"), str)):
+            return entry["fingerprint"].encode("utf-8")
 
         cmd = [
             '/usr/bin/ssh-keygen',
@@ -191,18 +479,58 @@ class SSHKey():
             self.id_file]
 
         out = subprocess.check_output(cmd)
-        self.fingerprint = out.strip().split()[1]
-        logging.debug("Key fingerprint is: {}".format(self.fingerprint))
+        fingerprint = out.strip().split()[1]
+
+        cache[self.id_file] = {
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "fingerprint": fingerprint.decode("utf-8"),
+        }
+        self._write_fingerprint_cache(cache)
+        return fingerprint
+
+    def get_fingerprint(self):
+        """
+        Return fingerprint of SSH identity file
+        """
+        if self.id_file is None:
+            return None
+
+        if self.fingerprint is not None:
+            return self.fingerprint
+
+        self.fingerprint = self._get_pubkey_fingerprint()
+        if self.fingerprint is None:
+            self.fingerprint = self._get_keygen_fingerprint()
+
+        logging.debug("Key fingerprint is: %s", self.fingerprint)
         return self.fingerprint
 
-    def check_key_exists(self, env):
-        cmd = ["ssh-add", "-l"]
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT,
-                                env=env)
-        out, err = proc.communicate()
-        return self.get_fingerprint() in out.split()
+    def check_key_exists(self):
+        """
+        Check whether the agent at $SSH_AUTH_SOCK already holds this key
+
+        Stops reading ssh-add's output at the first matching line.
+        """
+        fingerprint = self.get_fingerprint()
+        cmd = ["/usr/bin/ssh-add", "-l"]
+        with subprocess.Popen(cmd,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT) as proc:
+            for line in proc.stdout:
+                if fingerprint in line.split():
+                    proc.kill()
+                    return True
+        return False
+
+    @property
+    def multiplexed(self):
+        """
+        Whether the ssh config already sets up connection sharing
+        """
+        config = self._host_config
+        return ("controlpath" in config or
+                config.get("controlmaster") not in (None, ["false"]))
 
     @property
     def empty(self):
@@ -213,28 +541,69 @@ class SSHKey():
         return self.id_file
 
 
-def parse_known_args(args):
-    """Parse commandline arguments."""
-    parser = argparse.ArgumentParser(
-        usage='sshecret [--socket] [whatever you want to pass to ssh]',
-        description=DESCRIPTION,
-        formatter_class=argparse.RawTextHelpFormatter)
-    for flagname in SSH_FLAGS:
-        parser.add_argument(flagname, action='count',
-                            help=argparse.SUPPRESS)
-    for optionname in SSH_ARGS:
-        parser.add_argument(optionname, help=argparse.SUPPRESS)
+def _parse_short_flags(arg, args, parsed):
+    """
+    Parse one argument of ssh(1) short flags, such as ``-Avv`` or ``-p22``
+
+    If the last flag takes a value from the next argument, it is consumed
+    from the args iterator.
+    """
+    for i, flag in enumerate(arg[1:], 2):
+        if '-' + flag in SSH_ARGS:
+            # The value is either the rest of this argument or the next one
+            value = arg[i:]
+            if i == len(arg):
+                value = next(args, '')
+            if flag == 'S' or (
+                    flag == 'o' and value.lower().startswith('control')):
+                parsed.multiplexed = True
+            return
+        if flag == 'M':
+            parsed.multiplexed = True
+        if flag == 'v':
+            parsed.verbose += 1
 
-    parser.add_argument('-v', action='count', dest="verbose",
-                        help='Increase verbosity of output')
 
-    parser.add_argument('--socket', dest="sshecret_print_socket",
-                        action='store_true',
-                        help='print socket path for the given host')
+def parse_args(args):
+    """
+    Parse commandline arguments.
 
-    parser.add_argument('hostname', help=argparse.SUPPRESS)
-    parser.add_argument('command', nargs='?', help=argparse.SUPPRESS)
-    return parser.parse_known_args(args)
+    Walks the arguments once the way ssh(1) does, picking out the options
+    sshecret cares about along with the hostname and the remote command.
+    """
+    parsed = types.SimpleNamespace(verbose=0,
+                                   sshecret_print_socket=False,
+                                   multiplexed=False,
+                                   hostname=None,
+                                   command=None)
+    args = iter(args)
+    options_done = False
+    for arg in args:
+        if options_done or not arg.startswith('-') or arg == '-':
+            if parsed.hostname is None:
+                parsed.hostname = arg
+                continue
+            parsed.command = arg
+            break
+
+        if arg == '--':
+            options_done = True
+        elif arg == '--socket':
+            parsed.sshecret_print_socket = True
+        elif arg in ('-h', '--help'):
+            print(USAGE)
+            print(DESCRIPTION + OPTIONS)
+            sys.exit(0)
+        else:
+            _parse_short_flags(arg, args, parsed)
+
+    if parsed.hostname is None:
+        print(USAGE, file=sys.stderr)
+        print('sshecret: error: the following arguments are required: '
+              'hostname', file=sys.stderr)
+        sys.exit(2)
+
+    return parsed
 
 
 def setup_logging(verbose):
@@ -246,41 +615,66 @@ def setup_logging(verbose):
     if verbose > 0:
         level = logging.DEBUG
 
-    logging.root.handlers = []
-    logging.basicConfig(level=level, format=LOG_FORMAT)
+    logging.basicConfig(format=LOG_FORMAT)
+    logging.getLogger().setLevel(level)
 
 
 def get_host(hostname):
     """Extract hostname from ssh-style command line args"""
-    # Handle the [user]@[hostname] syntax
-    if '@' in hostname:
-        hostname = hostname.split('@')[1]
-
     # If for some whacky reason the hostname has a protocol...
     if hostname.startswith('ssh://'):
         hostname = hostname[len('ssh://'):]
 
+    # Handle the [user]@[hostname] syntax
+    hostname = hostname.rpartition('@')[2]
+
     # Handle a port in the hostname
-    if ':' in hostname:
-        hostname = hostname.split(':')[0]
+    hostname = hostname.partition(':')[0]
 
-    logging.debug('Hostname is {}'.format(hostname))
+    logging.debug('Hostname is %s', hostname)
     return hostname
 
 
+def get_control_args():
+    """
+    ssh options to share one connection per destination
+
+    Connection sharing is opt-in: $SSHECRET_CONTROL_PERSIST holds the
+    ControlPersist time, e.g. ``10m``. The first connection becomes a
+    master that lingers in the background for that long, and later
+    connections reuse it instead of doing a new handshake and agent
+    negotiation. Returns no options if it is unset, or if there is no
+    $XDG_RUNTIME_DIR to put the control socket in.
+    """
+    persist = os.getenv("SSHECRET_CONTROL_PERSIST")
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if not persist or not runtime_dir:
+        return []
+
+    control_path = os.path.join(runtime_dir, "sshecret-%C.ctl")
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={control_path}",
+        "-o", f"ControlPersist={persist}",
+    ]
+
+
 def run_ssh(args, sock=None):
     """
     Exec ssh in the environemnt
+
+    Without a sock, ssh gets no agent at all rather than the caller's,
+    which would hand every key it holds to a host reached with -A.
     """
-    env = {}
     if sock is not None:
-        logging.info('SSH_AUTH_SOCK={}'.format(sock))
-        env = os.environ.copy()
-        env["SSH_AUTH_SOCK"] = sock
+        logging.info('SSH_AUTH_SOCK=%s', sock)
+        os.environ["SSH_AUTH_SOCK"] = sock
+    else:
+        os.environ.pop("SSH_AUTH_SOCK", None)
 
     ssh = ["/usr/bin/ssh"]
     ssh.extend(args)
-    os.execve("/usr/bin/ssh", ssh, env)
+    os.execv("/usr/bin/ssh", ssh)
 
 
 def main(args):
@@ -290,17 +684,15 @@ def main(args):
     #. Find the host
     #. Find the keyfile for the host in the ssh config
     #. Create the ssh-agent and socket
-    #. Exec ssh
+    #. Exec ssh, sharing connections if asked to
     """
-    args, extra = parse_known_args(args)
+    args = parse_args(args)
 
-    verbose = 0
-    if args.verbose:
-        verbose = args.verbose
-    setup_logging(verbose)
+    setup_logging(args.verbose)
 
     host = get_host(args.hostname)
-    sock = SSHSock(SSHKey(host))
+    key = SSHKey(host)
+    sock = SSHSock(key)
 
     # If other sshecret-specific arguments are added which don't do an early
     # return before calling ssh(1), it may be necessary to filter sys.argv.
@@ -308,7 +700,12 @@ def main(args):
         print('SSH_AUTH_SOCK={}'.format(quote(sock.get_sock_path())))
         return
 
-    run_ssh(sys.argv[1:], sock.create())
+    ssh_args = sys.argv[1:]
+    control_args = get_control_args()
+    if control_args and not args.multiplexed and not key.multiplexed:
+        ssh_args = control_args + ssh_args
+
+    run_ssh(ssh_args, sock.create())
 
 
 if __name__ == "__main__":
@@ -2,7 +2,14 @@
 """
 Tests for sshecret
 """
+import hashlib
+import os
+import pwd
+import socket
+import subprocess
+import tempfile
 import unittest
+from unittest import mock
 
 sshecret = __import__('sshecret')
 
@@ -40,18 +47,319 @@ class TestArgParse(unittest.TestCase):
     """
     Test argument parsing
     """
-    def test_parse_known_args(self):
-        args, extra = sshecret.parse_known_args(['-v', 'foo@example.com:2222'])
+    def test_parse_args(self):
+        args = sshecret.parse_args(['-v', 'foo@example.com:2222'])
         assert args.verbose > 0
         assert args.hostname == 'foo@example.com:2222'
-        assert not extra
+        assert args.command is None
 
     def test_socket_arg(self):
-        args, extra = sshecret.parse_known_args(['--socket', 'foo@example.com:2222'])
+        args = sshecret.parse_args(['--socket', 'foo@example.com:2222'])
         assert args.hostname == 'foo@example.com:2222'
-        assert not extra
         assert args.sshecret_print_socket is True
 
+    def test_option_values(self):
+        args = sshecret.parse_args(['-p', '2222', '-lfoo', '-Avv',
+                                    '-o', 'User=bar', 'example.com'])
+        assert args.verbose == 2
+        assert args.hostname == 'example.com'
+
+    def test_command(self):
+        args = sshecret.parse_args(['example.com', '-v', 'ls', '-l'])
+        assert args.verbose == 1
+        assert args.hostname == 'example.com'
+        assert args.command == 'ls'
+
+    def test_multiplexed(self):
+        args = sshecret.parse_args(['-v', 'example.com'])
+        assert not args.multiplexed
+        args = sshecret.parse_args(['-oControlPath=none', 'example.com'])
+        assert args.multiplexed
+        args = sshecret.parse_args(['-S', '/tmp/ctl', 'example.com'])
+        assert args.multiplexed
+
+    def test_missing_hostname(self):
+        with mock.patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                sshecret.parse_args(['-p', '2222'])
+
+
+class TestRunSSH(unittest.TestCase):
+    """
+    Test the environment ssh is exec'd with
+    """
+    def exec_env(self, sock):
+        env = {}
+        with mock.patch('os.execv',
+                        side_effect=lambda *a: env.update(os.environ)):
+            sshecret.run_ssh(['example.com'], sock)
+        return env
+
+    @mock.patch.dict(os.environ, {'SSH_AUTH_SOCK': '/tmp/desktop.sock'})
+    def test_sock(self):
+        env = self.exec_env('/tmp/sshecret.sock')
+        assert env['SSH_AUTH_SOCK'] == '/tmp/sshecret.sock'
+
+    @mock.patch.dict(os.environ, {'SSH_AUTH_SOCK': '/tmp/desktop.sock'})
+    def test_no_sock_hides_callers_agent(self):
+        env = self.exec_env(None)
+        assert 'SSH_AUTH_SOCK' not in env
+        assert 'PATH' in env
+
+
+class _TmpEnvTestCase(unittest.TestCase):
+    """
+    Base for tests needing a scratch directory and a patched environment
+    """
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.config = os.path.join(self.tmp, 'config')
+
+    def patch_env(self, **env):
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_config(self, text):
+        with open(self.config, 'w') as f:
+            f.write(text)
+
+
+class TestSockPath(_TmpEnvTestCase):
+    """
+    Test socket naming
+    """
+    def setUp(self):
+        super().setUp()
+        self.patch_env(XDG_RUNTIME_DIR=self.tmp)
+        self.key = mock.Mock(file='/home/test/.ssh/id_test')
+
+    def make_sock(self, path, listen):
+        """
+        Bind a unix socket at path, left dead unless listen is set
+        """
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(path)
+        if listen:
+            sock.listen()
+        else:
+            sock.close()
+
+    def legacy_path(self):
+        return os.path.join(self.tmp, '{}.sock'.format(
+            hashlib.md5(self.key.file.encode('utf-8')).hexdigest()))
+
+    def test_legacy_sock_is_renamed(self):
+        legacy = self.legacy_path()
+        self.make_sock(legacy, listen=True)
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        assert not os.path.exists(legacy)
+        assert sock._agent_running(sock_file)
+
+    def test_dead_legacy_sock_is_not_running(self):
+        self.make_sock(self.legacy_path(), listen=False)
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        assert os.path.exists(sock_file)
+        assert not sock._agent_running(sock_file)
+
+    def test_new_sock_is_kept(self):
+        sock_file = sshecret.SSHSock(self.key).get_sock_path()
+        assert os.path.dirname(sock_file) == self.tmp
+        assert not os.path.exists(sock_file)
+
+    def test_start_agent_writes_pid(self):
+        out = (b'SSH_AUTH_SOCK=/tmp/x.sock; export SSH_AUTH_SOCK;\n'
+               b'SSH_AGENT_PID=1234; export SSH_AGENT_PID;\n'
+               b'echo Agent pid 1234;\n')
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        with mock.patch('subprocess.check_output', return_value=out) as cmd:
+            sock._start_agent(sock_file)
+        assert '-s' in cmd.call_args[0][0]
+        with open(sock_file + '.pid', 'rb') as f:
+            assert f.read() == b'1234'
+
+    def test_agent_with_live_pid_is_running(self):
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        self.make_sock(sock_file, listen=False)
+        with open(sock_file + '.pid', 'w') as f:
+            f.write(str(os.getpid()))
+        assert sock._agent_running(sock_file)
+
+    def test_agent_with_dead_pid_is_not_running(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        self.make_sock(sock_file, listen=True)
+        with open(sock_file + '.pid', 'w') as f:
+            f.write(str(proc.pid))
+        assert not sock._agent_running(sock_file)
+
+    def test_non_socket_is_not_running(self):
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        with open(sock_file, 'w'):
+            pass
+        assert not sock._agent_running(sock_file)
+
+    def test_missing_key_is_added_again(self):
+        self.key.empty = False
+        self.key.check_key_exists.return_value = False
+        sock = sshecret.SSHSock(self.key)
+        sock_file = sock.get_sock_path()
+        with mock.patch.object(sock, '_agent_running', return_value=True), \
+                mock.patch.object(sock, '_add_key') as add_key:
+            assert sock.create() == sock_file
+        add_key.assert_called_once_with(sock_file)
+
+
+class TestConfigCache(_TmpEnvTestCase):
+    """
+    Test that host configs are resolved once per config file
+    """
+    def setUp(self):
+        super().setUp()
+        self.write_config('Host cache.example.com\n'
+                          '  IdentityFile /tmp/id_one\n')
+        self.patch_env(SSH_CONF_PATH=self.config)
+
+    def test_ssh_runs_once(self):
+        with mock.patch('subprocess.run', wraps=subprocess.run) as cmd:
+            assert sshecret.SSHKey('cache.example.com').file == '/tmp/id_one'
+            assert sshecret.SSHKey('cache.example.com').file == '/tmp/id_one'
+        assert cmd.call_count == 1
+
+    def test_changed_config_is_reread(self):
+        sshecret.SSHKey('cache.example.com').file
+        self.write_config('Host cache.example.com\n'
+                          '  IdentityFile /tmp/id_two\n')
+        os.utime(self.config, ns=(0, 0))
+        assert sshecret.SSHKey('cache.example.com').file == '/tmp/id_two'
+
+    def test_identity_file_is_expanded(self):
+        self.write_config('Host cache.example.com\n'
+                          '  IdentityFile ~/keys/../.ssh/id_test\n')
+        self.patch_env(HOME='/home/test')
+        key = sshecret.SSHKey('cache.example.com')
+        assert key.file == '/home/test/.ssh/id_test'
+
+    def test_identity_file_tokens_are_expanded(self):
+        self.write_config('Host cache.example.com\n'
+                          '  HostName real.example.com\n'
+                          '  User bob\n'
+                          '  IdentityFile %d/.ssh/%r@%h_%u%%\n')
+        self.patch_env(HOME='/home/test')
+        user = pwd.getpwuid(os.getuid()).pw_name
+        key = sshecret.SSHKey('cache.example.com')
+        assert key.file == \
+            '/home/test/.ssh/bob@real.example.com_{}%'.format(user)
+
+    def test_identity_file_local_host_tokens_are_expanded(self):
+        self.write_config('Host cache.example.com\n'
+                          '  IdentityFile /keys/%L_%l_%n_%p\n')
+        with mock.patch('socket.gethostname', return_value='box.example.org'):
+            key = sshecret.SSHKey('cache.example.com')
+            assert key.file == \
+                '/keys/box_box.example.org_cache.example.com_22'
+
+    def test_identity_file_hash_token_matches_ssh(self):
+        self.write_config('Host cache.example.com\n'
+                          '  IdentityFile /keys/%C\n')
+        out = subprocess.run(
+            ['ssh', '-G', '-F', self.config, '-o', 'ControlPath=%C',
+             'cache.example.com'],
+            capture_output=True, text=True, check=True).stdout
+        control_path = [line.split()[1] for line in out.splitlines()
+                        if line.startswith('controlpath ')][0]
+        key = sshecret.SSHKey('cache.example.com')
+        assert key.file == '/keys/' + control_path
+
+
+class TestControlArgs(_TmpEnvTestCase):
+    """
+    Test opt-in connection sharing
+    """
+    def setUp(self):
+        super().setUp()
+        self.write_config('Host auto.example.com\n  ControlMaster auto\n'
+                          'Host path.example.com\n  ControlPath /tmp/%C\n'
+                          'Host no.example.com\n  ControlMaster no\n')
+        self.patch_env(SSH_CONF_PATH=self.config,
+                       XDG_RUNTIME_DIR=self.tmp,
+                       SSHECRET_CONTROL_PERSIST='10m')
+
+    def test_control_args(self):
+        control_path = os.path.join(self.tmp, 'sshecret-%C.ctl')
+        assert sshecret.get_control_args() == [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(control_path),
+            '-o', 'ControlPersist=10m',
+        ]
+
+    def test_opt_in(self):
+        del os.environ['SSHECRET_CONTROL_PERSIST']
+        assert sshecret.get_control_args() == []
+
+    def test_without_runtime_dir(self):
+        del os.environ['XDG_RUNTIME_DIR']
+        assert sshecret.get_control_args() == []
+
+    def test_multiplexed(self):
+        assert sshecret.SSHKey('auto.example.com').multiplexed
+        assert sshecret.SSHKey('path.example.com').multiplexed
+        assert not sshecret.SSHKey('other.example.com').multiplexed
+        # ssh -G can't tell this apart from no setting at all
+        assert not sshecret.SSHKey('no.example.com').multiplexed
+
+
+class TestFingerprintCache(_TmpEnvTestCase):
+    """
+    Test the on-disk fingerprint cache
+    """
+    def setUp(self):
+        super().setUp()
+        self.id_file = os.path.join(self.tmp, 'id_test')
+        with open(self.id_file, 'w') as f:
+            f.write('key')
+        self.write_config(
+            'Host example.com\n  IdentityFile {}\n'.format(self.id_file))
+        self.patch_env(SSH_CONF_PATH=self.config, XDG_RUNTIME_DIR=self.tmp)
+
+    def test_ssh_keygen_runs_once(self):
+        out = b'256 SHA256:abc comment (ED25519)\n'
+        with mock.patch('subprocess.check_output', return_value=out) as cmd:
+            key = sshecret.SSHKey('example.com')
+            assert key.get_fingerprint() == b'SHA256:abc'
+            key = sshecret.SSHKey('example.com')
+            assert key.get_fingerprint() == b'SHA256:abc'
+        assert cmd.call_count == 1
+
+    def test_changed_key_is_refreshed(self):
+        out = b'256 SHA256:abc comment (ED25519)\n'
+        with mock.patch('subprocess.check_output', return_value=out) as cmd:
+            sshecret.SSHKey('example.com').get_fingerprint()
+            with open(self.id_file, 'w') as f:
+                f.write('new key')
+            sshecret.SSHKey('example.com').get_fingerprint()
+        assert cmd.call_count == 2
+
+    def test_public_key_skips_ssh_keygen(self):
+        with open(self.id_file + '.pub', 'w') as f:
+            f.write('ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIEcgbCaVlbgcXTtd3X10'
+                    'IGl2TljhefrfS6ZT0kS7nUAS test\n')
+        with mock.patch('subprocess.check_output') as cmd:
+            key = sshecret.SSHKey('example.com')
+            assert key.get_fingerprint() == \
+                b'SHA256:G8ilBUY+Qr2MvilAtIoLAZdvWYJlB14dZ5iDbnrRQ3E'
+        assert not cmd.called
+
 
 if __name__ == '__main__':
     unittest.main()